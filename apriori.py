@@ -1,12 +1,62 @@
-from tqdm import tqdm
-import collections
-import itertools
+from apriori_kernels import parse_tokens, count_support_kernel, count_support_kernel_w1, candidate_gen_kernel
+from numba import get_num_threads
+import numpy as np
+import mmap
+import os
+import pickle
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
 """
 Implements apriori algorithms and association rules.
 """
 
-def init_pass(file, minsup):
+# Items contained in more than this fraction of the transactions have their tidlist stored as a packed bitmap instead
+# of as an array of transaction IDs (see load_tidlists()). Past this point the bitmap, at one bit per transaction, is
+# the smaller of the two, since a transaction ID takes 32 bits.
+TIDLIST_DENSITY = 1 / 32
+
+# The most memory, in bytes, that a single block of the GPU support count may use for its intermediate
+# (n_transactions, block, n_words) array. Larger levels are counted in several blocks of candidates.
+GPU_BLOCK_BYTES = 2 ** 28
+
+# The support counts of every itemset counted by the last apriori() run, keyed by the sorted tuple of its item labels.
+# The empty itemset maps to the number of transactions. genRules() and ap_genRules() read every count they need from
+# here, and save_support_cache() and load_support_cache() carry it across sessions, so that rules can be regenerated
+# at a different minimum confidence without re-running apriori().
+support_cache = {}
+
+
+def save_support_cache(path):
+    """
+    Pickles support_cache to the file at path.
+    """
+    with open(path, "wb") as f:
+        pickle.dump(support_cache, f)
+
+
+def load_support_cache(path):
+    """
+    Replaces the contents of support_cache with those pickled to the file at path by save_support_cache().
+    """
+    with open(path, "rb") as f:
+        cache = pickle.load(f)
+    support_cache.clear()
+    support_cache.update(cache)
+
+
+def cache_supports(item_ids, C_k, counts):
+    """
+    Records the counts of the itemsets in C_k, whose items are given by rank, in support_cache.
+    """
+    for c_k, count in zip(C_k, counts):
+        support_cache[tuple(sorted(int(item_ids[rank]) for rank in c_k))] = int(count)
+
+
+def load_bitmatrix(file):
     """
     File is an inputted comma-separated list of transactions whose first item is the counter for the line number of
     the transaction, and each item afterwards is the index of the item under consideration. Example:
@@ -17,6 +67,77 @@ def init_pass(file, minsup):
         4,99,101,12
         ...
 
+    load_bitmatrix reads this file exactly once and returns it as a (M, item_ids) tuple. M is a dense boolean matrix
+    of shape (n_transactions, n_items), and item_ids is the sorted array of the distinct items in the file, such that
+    M[t, j] is True if and only if transaction t contains the item item_ids[j].
+
+    Every level of the apriori algorithm needs to count support against the full list of transactions. Reading the
+    file into this matrix once and reusing it for every level is far cheaper than re-reading and re-parsing the file,
+    building a Python set for every line, on every level.
+    """
+    # The file is mapped into memory rather than read into a copy, and parsed straight out of the mapping. The mapping
+    # is closed when the last reference to it goes, rather than by a with block: a ValueError raised by
+    # parse_transactions() holds on to the buffer in its traceback, and closing a mapping that is still exported fails.
+    with open(file, "rb") as f:
+        # An empty file has no transactions, and can't be mapped.
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.zeros((0, 0), dtype=bool), np.zeros(0, dtype=np.int64)
+        rows, items, n = parse_transactions(
+            np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+        )
+    item_ids = np.unique(items)
+    M = np.zeros((n, len(item_ids)), dtype=bool)
+    M[rows, np.searchsorted(item_ids, items)] = True
+    return M, item_ids
+
+
+def parse_transactions(buf):
+    """
+    Parses buf, the bytes of a transaction file (see load_bitmatrix()) as a uint8 array. Returns a (rows, items, n)
+    tuple: every item of every transaction flattened into one array, the (zero-indexed) transaction each of them
+    belongs to, and the number of transactions n. Raises a ValueError naming the line if any item is not a non-negative
+    integer.
+    """
+    # The line read is "transaction_number, item, ..., item\n". The first item in the line is a count and needs to
+    # be removed.
+    # Rather than tokenizing line by line in Python, we treat the whole file as one long list of integers separated by
+    # either commas or newlines. Every token starts at the beginning of the file or right after one of those, so the
+    # offsets of all of the tokens come out of a vectorized scan of the buffer, and the compiled parse_tokens() then
+    # parses all of them in parallel. The only thing we need from the lines themselves is how many tokens each
+    # contributed, which is one more than the number of commas between consecutive newlines.
+    end = len(buf)
+    while end and int(buf[end - 1]) in b" \t\r\n":
+        end -= 1
+    buf = buf[:end]
+    newlines = np.flatnonzero(buf == ord("\n"))
+    commas = np.flatnonzero(buf == ord(","))
+    n = len(newlines) + 1
+    lengths = np.bincount(np.searchsorted(newlines, commas), minlength=n) + 1
+    starts = np.sort(np.concatenate(([0], newlines + 1, commas + 1)))
+    tokens = np.empty(len(starts), dtype=np.int64)
+    valid = np.empty(len(starts), dtype=bool)
+    parse_tokens(buf, starts, tokens, valid)
+    # Drop the first token of every line, and label every remaining token with the transaction it belongs to.
+    is_item = np.ones(len(tokens), dtype=bool)
+    is_item[np.cumsum(lengths) - lengths] = False
+    # Every item must be a non-negative integer. Anything else (a header line, a negative or fractional number, an empty
+    # item left by a trailing comma) is an error, as it was when every item went through int(), rather than being read
+    # as some other item.
+    invalid = np.flatnonzero(is_item & ~valid)
+    if len(invalid):
+        line = np.searchsorted(newlines, starts[invalid[0]]) + 1
+        end = newlines[line - 1] if line <= len(newlines) else len(buf)
+        text = bytes(buf[(newlines[line - 2] + 1 if line > 1 else 0):end]).decode(errors="replace")
+        raise ValueError("Line {} of the transaction file is not a list of non-negative integers: {!r}".format(
+            line, text))
+    rows = np.repeat(np.arange(n), lengths)[is_item]
+    return rows, tokens[is_item], n
+
+
+def init_pass(M, item_ids, minsup):
+    """
+    M and item_ids are the bitmatrix and item labels of the transaction file, as returned by load_bitmatrix().
+
     The goal of init_pass is to return every individual item in the itemsets which is, taken by itself, "frequent",
     in the sense that it occurs at least minsup*100 percent of the time.
 
@@ -24,30 +145,272 @@ def init_pass(file, minsup):
     function.
 
     Note that this algorithm actually returns (itemset, n). Every loop in the apriori algorithm requires reading in
-    n, and it's more efficient to read it once here (since we are reading the file anyway) and pass it along for use
-    in the apriori algorithm.
-    """
-    # The file being read is 75000-out1.csv. The line read is "transaction_number, item, ..., item\n"
-    # 1. The first item in the line is a count and needs to be removed.
-    # 2. Naive tokenization will read " number", e.g. " 2", but int(" 2") actually works fine!
-    # 3. There is no more efficient way to get a line length than to read the lines as they come in with a
-    #    counter.
-    # 4. The length of the transaction set, n, is required for each loop in the apriori algorithm.
-    #    For efficacy thus init_pass returns a (itemset, n) tuple.
-    count = collections.Counter()
-    n = 0
-    with open(file) as f:
-        for line in tqdm(f):
-            n += 1
-            for item in {int(n) for n in line.replace("\n", "").split(",")[1:]}:
-                count[item] += 1
-    return [[item] for (item, count) in count.items() if count / n > minsup], n
-
-
-def apriori(file, minsup):
+    n, the number of transactions, so it is returned here for reuse.
+
+    The itemsets are returned in order of descending support, which is the order rank_items() relabels them in.
+    """
+    n = M.shape[0]
+    # The support of every single item is just the column sum of the bitmatrix.
+    counts = M.sum(axis=0)
+    order = np.argsort(-counts, kind="stable")
+    return [(int(item),) for item in item_ids[order[counts[order] / n > minsup]]], n
+
+
+def rank_items(M, item_ids, F_1):
+    """
+    Relabels the items in the bitmatrix M by their frequency rank. F_1 is the list of frequent items returned by
+    init_pass(), most frequent first. Returns (M, item_ids) again: M restricted to the columns of the frequent items,
+    so that column r holds the r-th most frequent item, and the item labels of those columns.
+
+    Item labels in the file are arbitrary integers, and infrequent items can never be part of a frequent itemset.
+    Dropping their columns keeps the packed bitsets as narrow as possible, and ordering the rest by rank puts the
+    hottest items together in the first word. From here on apriori() refers to items by rank (column index) alone,
+    and maps them back to their labels through item_ids at the end.
+    """
+    cols = np.searchsorted(item_ids, [item for (item,) in F_1])
+    return M[:, cols], item_ids[cols]
+
+
+def deduplicate(M):
+    """
+    Collapses identical rows of the bitmatrix M into one. Returns (M, weights): the distinct rows, and the number of
+    transactions each of them stands for.
+
+    Once the infrequent items are dropped by rank_items(), many transactions are identical; in 75000-out1.csv fewer
+    than half of them are distinct. A row counted once with weight w costs a w-th of counting it w times, and support
+    is the same either way. The rows are compared in their packed form, which is a handful of words per row rather
+    than one byte per item.
+    """
+    _, first, weights = np.unique(pack_bitmatrix(M), axis=0, return_index=True, return_counts=True)
+    return M[first], weights.astype(np.int32)
+
+
+def pack_bitsets(itemsets, n_words):
+    """
+    Packs every row of itemsets, a 2D integer array of bitmatrix column indices, into a bitset of n_words 64-bit
+    words, in which bit i % 64 of word i // 64 is set if and only if column i is in the row. Returns a uint64 matrix
+    of shape (len(itemsets), n_words).
+
+    Every item of every row is scattered into its word with a single vectorized bitwise_or, rather than packing the
+    rows one by one in Python.
+    """
+    rows = np.repeat(np.arange(itemsets.shape[0]), itemsets.shape[1])
+    items = itemsets.ravel()
+    bits = np.zeros((itemsets.shape[0], n_words), dtype=np.uint64)
+    np.bitwise_or.at(bits, (rows, items // 64), np.uint64(1) << (items % 64).astype(np.uint64))
+    return bits
+
+
+def pack_bitmatrix(M):
+    """
+    Packs every row of the boolean bitmatrix M (see load_bitmatrix()) into a bitset in the format of pack_bitsets(),
+    returning a uint64 matrix T of shape (n_transactions, ceil(n_items / 64)).
+    """
+    n_words = -(-M.shape[1] // 64)
+    # np.packbits with little bit order puts column i in bit i % 8 of byte i // 8. Padding each row out to a whole
+    # number of words and reading the bytes back as little-endian 64-bit words puts it in bit i % 64 of word i // 64.
+    packed = np.packbits(M, axis=1, bitorder="little")
+    packed = np.pad(packed, ((0, 0), (0, n_words * 8 - packed.shape[1])))
+    return np.ascontiguousarray(packed).view("<u8").astype(np.uint64)
+
+
+def item_bloom(items):
+    """
+    Returns the single-word Bloom filter of each of the bitmatrix column indices in the (array of) items: a uint64 with
+    two bits set, picked by two independent multiplicative hashes of the item.
+
+    The Bloom filter of a set of items is the OR of the Bloom filters of its members. A transaction can only contain a
+    candidate if every bit of the candidate's Bloom filter is also set in the transaction's, so one word-wide test
+    rules most candidates out of most transactions before any word of their bitsets is compared.
+    """
+    items = np.asarray(items, dtype=np.uint64)
+    h_1 = (items * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(58)
+    h_2 = (items * np.uint64(0xC2B2AE3D27D4EB4F)) >> np.uint64(58)
+    return (np.uint64(1) << h_1) | (np.uint64(1) << h_2)
+
+
+def bloom_summary(M):
+    """
+    Returns the item_bloom() Bloom filter of every transaction in the boolean bitmatrix M (see load_bitmatrix()), as
+    a uint64 array of length n_transactions.
+    """
+    tx_bloom = np.zeros(M.shape[0], dtype=np.uint64)
+    for j, bloom in enumerate(item_bloom(np.arange(M.shape[1]))):
+        tx_bloom[M[:, j]] |= bloom
+    return tx_bloom
+
+
+def count_support(T, tx_bloom, weights, C_k, minsup=0.0):
+    """
+    Counts the number of transactions in the packed bitmatrix T (see pack_bitmatrix()) containing each of the
+    k-itemsets in the candidate list C_k. tx_bloom is the Bloom filter of every row of T (see bloom_summary()), and
+    weights the number of identical transactions each row stands for (see deduplicate()). The items of the candidates
+    are column indices of T.
+
+    Returns a (counts, frequent) tuple of arrays in the same order as C_k: the counts themselves, and a boolean mask of
+    the candidates which are frequent with minimum support minsup. The mask is written by the same kernel which does
+    the counting, so that selecting the next level's itemsets doesn't need another pass over the counts.
+
+    Each candidate is packed into a bitset c of the same shape as a row of T. A transaction t contains the candidate
+    if and only if every bit set in c is also set in t, that is if t & c has as many bits set as c does. This is
+    evaluated for every (transaction, candidate) pair by the compiled count_support_kernel(), which is a handful of
+    word-wide ANDs and popcounts instead of a Python set lookup for every item. Pairs whose Bloom filters already rule
+    the candidate out are skipped without comparing the bitsets at all.
+
+    Before any of that, the candidates are grouped by their rarest item, and a transaction which doesn't have that item
+    skips every candidate of its group with a single bit test. The rarest item is missing from most transactions, so
+    this rules out most pairs without looking at them one by one. Since items are ranked by descending support (see
+    rank_items()), the rarest item of a candidate is simply its highest-ranked one. The counts are put back into the
+    order of C_k afterwards.
+
+    With at most 64 frequent items every bitset is a single word, and count_support_kernel_w1() is used instead. It
+    drops the loop over words and the Bloom filters, which at that width cost as much as the test they guard.
+
+    If T is a CuPy array, that is if it was moved to the GPU by apriori(file, minsup, backend="gpu"), the count is done
+    on the GPU by count_support_gpu() instead.
+    """
+    if not len(C_k):
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.bool_)
+    n_words = T.shape[1]
+    n = int(weights.sum())
+    cols = np.asarray(C_k, dtype=np.int64).reshape(len(C_k), -1)
+    if cp is not None and isinstance(T, cp.ndarray):
+        counts = count_support_gpu(T, weights, pack_bitsets(cols, n_words))
+        return counts, counts / n > minsup
+    rarest = cols.max(axis=1)
+    order = np.argsort(rarest, kind="stable")
+    cols, rarest = cols[order], rarest[order]
+    run_start = np.flatnonzero(np.r_[True, rarest[1:] != rarest[:-1], True])
+    C = pack_bitsets(cols, n_words)
+    sorted_counts = np.zeros(len(C_k), dtype=np.int32)
+    sorted_frequent = np.zeros(len(C_k), dtype=np.bool_)
+    if n_words == 1:
+        count_support_kernel_w1(
+            T.ravel(), weights, C.ravel(), rarest[run_start[:-1]], run_start, n, minsup, get_num_threads(),
+            sorted_counts, sorted_frequent
+        )
+    else:
+        cand_bloom = np.bitwise_or.reduce(item_bloom(cols), axis=1)
+        count_support_kernel(
+            T, weights, tx_bloom, C, cand_bloom, rarest[run_start[:-1]], run_start, n, minsup, get_num_threads(),
+            sorted_counts, sorted_frequent
+        )
+    counts = np.empty_like(sorted_counts)
+    frequent = np.empty_like(sorted_frequent)
+    counts[order], frequent[order] = sorted_counts, sorted_frequent
+    return counts, frequent
+
+
+def count_support_gpu(T, weights, C):
+    """
+    GPU counterpart of count_support_kernel(). T is the packed transaction matrix as a CuPy array, weights the number
+    of transactions each of its rows stands for, and C the packed candidates as a NumPy array. Returns the number of
+    transactions containing each candidate as a NumPy array.
+
+    Counting support is the same independent test for every (transaction, candidate) pair, so on the GPU it is just
+    the broadcast (T[:, None, :] & C) == C, reduced over the words and then over the transactions. The intermediate
+    has one element per transaction, candidate and word, so the candidates are sent over in blocks sized to keep it
+    under GPU_BLOCK_BYTES.
+    """
+    counts = np.zeros(C.shape[0], dtype=np.int32)
+    weights = cp.asarray(weights)
+    block = max(1, GPU_BLOCK_BYTES // max(1, T.shape[0] * T.shape[1] * T.itemsize))
+    for start in range(0, C.shape[0], block):
+        C_block = cp.asarray(C[start:start + block])
+        contained = ((T[:, None, :] & C_block) == C_block).all(axis=2)
+        counts[start:start + block] = (contained * weights[:, None]).sum(axis=0).get()
+    return counts
+
+
+def load_tidlists(M):
+    """
+    Returns the vertical, or "tidlist", representation of the boolean bitmatrix M (see load_bitmatrix()): a dict
+    mapping every column of M to the transactions (rows) containing that item.
+
+    For most items this is the sorted int32 array of the IDs of those transactions. But the tidlist of an item
+    contained in more than TIDLIST_DENSITY of the transactions is instead stored as a bitmap of all of the
+    transactions, packed eight to a uint8 in the format of np.packbits(..., bitorder="little"), whichever is smaller.
+    intersect_tidlists() handles any combination of the two.
+    """
+    n = M.shape[0]
+    tids = {}
+    for j in range(M.shape[1]):
+        column = M[:, j]
+        if column.sum() / n > TIDLIST_DENSITY:
+            tids[j] = np.packbits(column, bitorder="little")
+        else:
+            tids[j] = np.flatnonzero(column).astype(np.int32)
+    return tids
+
+
+def intersect_tidlists(a, b):
+    """
+    Intersects two tidlists in either of the formats described in load_tidlists(). The result is a bitmap if both a
+    and b are, and an array of transaction IDs otherwise.
+    """
+    if a.dtype == np.uint8 and b.dtype == np.uint8:
+        return a & b
+    if a.dtype == np.uint8:
+        a, b = b, a
+    if b.dtype == np.uint8:
+        # Look up each of a's IDs in b's bitmap.
+        return a[(b[a >> 3] >> (a & 7).astype(np.uint8)) & 1 == 1]
+    return np.intersect1d(a, b, assume_unique=True)
+
+
+def tidlist_size(tids):
+    """
+    The number of transactions in a tidlist in either of the formats described in load_tidlists().
+    """
+    if tids.dtype == np.uint8:
+        return int(np.unpackbits(tids).sum())
+    return len(tids)
+
+
+def count_support_tidlist(tids, n, C_k, minsup=0.0, prefix_tids=None):
+    """
+    The vertical counterpart of count_support(). tids are the tidlists returned by load_tidlists() for n
+    transactions. The items of the candidates in C_k are column indices of the bitmatrix the tidlists were built from.
+
+    Here the number of transactions containing a candidate is the size of the intersection of the tidlists of its
+    items, so there is no scan over the transactions at all. Intersecting with a rare item's short tidlist is cheap
+    and leaves a short result, so the cost tracks how rare the candidate is rather than how many transactions there
+    are.
+
+    prefix_tids optionally maps itemsets (as tuples) to their already intersected tidlists. A candidate whose first
+    k-1 items are in it costs just one intersection, of that tidlist with its last item's, rather than k-1. Since
+    candidate_gen() joins every candidate from a k-1-level frequent itemset and one more item, passing in the
+    frequent_tids of the previous level always hits.
+
+    Returns a (counts, frequent, frequent_tids) tuple: the (counts, frequent) of count_support(), and the dict of the
+    tidlists of the frequent candidates, for the next level's prefix_tids.
+    """
+    C_k = [tuple(c_k) for c_k in np.asarray(C_k).tolist()]
+    prefix_tids = prefix_tids or {}
+    counts = np.zeros(len(C_k), dtype=np.int32)
+    shared_tids = []
+    for j, c_k in enumerate(C_k):
+        if c_k[:-1] in prefix_tids:
+            shared = intersect_tidlists(prefix_tids[c_k[:-1]], tids[c_k[-1]])
+        else:
+            shared = tids[c_k[0]]
+            for item in c_k[1:]:
+                shared = intersect_tidlists(shared, tids[item])
+        counts[j] = tidlist_size(shared)
+        shared_tids.append(shared)
+    frequent = counts / n > minsup
+    frequent_tids = {c_k: shared for (c_k, shared, keep) in zip(C_k, shared_tids, frequent) if keep}
+    return counts, frequent, frequent_tids
+
+
+def apriori(file, minsup, backend="bitset"):
     """
     Implements the Apriori frequent itemset generation algorithm with minimum support minsup.
 
+    backend picks how support is counted: "bitset" (the default) by the Numba kernel behind count_support(), "gpu" by
+    the same packed transactions moved to the GPU, which requires CuPy, or "tidlist" by intersecting the vertical
+    tidlists of count_support_tidlist().
+
     File an inputted comma-separated list of transactions whose first item is the counter for the line number of
     the transaction, and each item afterwards is the index of the item under consideration. Example:
 
@@ -60,49 +423,69 @@ def apriori(file, minsup):
     The goal of apriori algorithm is to return all "frequent" itemsets in the dataset, in the sense that the
     itemsets occur at least minsup*100 percent of the time.
 
-    This search occurs in levels. Initially the algorithm generates a list of all singularly frequent itemsets,
-    using the init_pass() method described above. It passes this result to the F_k_minus_1 holder.
+    This search occurs in levels. The file is read into a bitmatrix once, using the load_bitmatrix() method described
+    above, and packed into one bitset and one Bloom filter per distinct transaction using deduplicate(),
+    pack_bitmatrix() and bloom_summary() (or, for the "tidlist" backend, turned into one tidlist per item using
+    load_tidlists()). Then the algorithm generates a list of all singularly frequent itemsets, using the init_pass()
+    method described above, and relabels the items by frequency rank using rank_items(). It passes this result to the
+    F_k_minus_1 holder.
 
     While F_k_minus_1 (consisting of itemsets of the k-1-level) is not empty, the apriori algorithm generates a list of
     k-level downwards closed candidate itemsets (generated using candidate_gen() below) and then validates them by
-    looping through the file, counting the number of occurrences of that set or subset in the itemsets present in the
-    transaction list, and eliminating those that are not frequent, in the sense that they do not have a certain
-    minimum "support" - they do not appear often enough in the data to be predicatively valuable.
+    counting the number of transactions containing each candidate (using count_support(), or its backend's
+    counterpart), and eliminating those that are not frequent, in the sense that they do not have a certain minimum
+    "support" - they do not appear often enough in the data to be predicatively valuable.
 
     Those that are deemed frequent are saved to the running tally and passed to the next iteration of the loop.
 
     The loop and the algorithm ends when F_k_minus_1 is empty, indicating that no further supersets can be built.
-    Then all that is left is to return the aggregated result, F_k.
+    Then all that is left is to return the aggregated result, F_k, with the items mapped back to their labels.
 
     Far more on the mechanics of this algorithm is contained in the candidate_gen() docstring.
     """
+    # Read the file once. Every level below counts support against the packed matrix instead of the file.
+    M, item_ids = load_bitmatrix(file)
     # Initialize the list of things with the list of all singular supported rules in the set.
     # Note that this is a modification of line 1,2 in the psuedocode, for efficiency we pass n here for reuse.
-    F_k_minus_1, n = init_pass(file, minsup)
+    F_1, n = init_pass(M, item_ids, minsup)
+    # Relabel the frequent items by rank. Everything up until the return now refers to items by rank.
+    M, item_ids = rank_items(M, item_ids, F_1)
+    F_k_minus_1 = np.arange(len(F_1), dtype=np.int32).reshape(-1, 1)
+    # Start a fresh support cache for this file.
+    support_cache.clear()
+    support_cache[()] = n
+    cache_supports(item_ids, F_k_minus_1, M.sum(axis=0))
+    if backend == "tidlist":
+        tids = load_tidlists(M)
+        prefix_tids = {(rank,): tidlist for (rank, tidlist) in tids.items()}
+    elif backend in ("bitset", "gpu"):
+        M, weights = deduplicate(M)
+        T = pack_bitmatrix(M)
+        tx_bloom = bloom_summary(M)
+        if backend == "gpu":
+            if cp is None:
+                raise ImportError("Counting support on the GPU requires CuPy.")
+            # The transactions are moved to the GPU once, and stay there for every level. count_support() notices.
+            T = cp.asarray(T)
+    else:
+        raise ValueError("Unknown backend {!r}.".format(backend))
     # The psuedocode doesn't instantiate F = U(F_k) until the end, confusingly.
-    F_k = F_k_minus_1
+    # Each level's itemsets are the rows of one int32 array (see candidate_gen()), so F_k maps every k to the (|F|, k)
+    # array of the frequent k-itemsets.
+    F_k = {1: F_k_minus_1}
     # Loop against F_k_minus_1 not being empty (which will occur once the itemsets become too long to remain relevant).
-    while F_k_minus_1:
-        count = collections.Counter()
+    while len(F_k_minus_1):
         # Use the existing list of candidates to generate the forward set.
         C_k = candidate_gen(F_k_minus_1)
-        # The loop assemblage below reads support count from the file.
-        with open(file) as f:
-            for line in tqdm(f):
-                # Pre-compute the itemset so all checks can be run without recalculating it.
-                check_set = {int(n) for n in line.replace("\n", "").split(",")[1:]}
-                for c_k in C_k:
-                    # print(set(c_k))
-                    # print({int(n) for n in line.replace("\n", "").split(",")[1:]})
-                    if set(c_k).issubset(check_set):
-                        # ☝: c_k is a list, thereby unhashable, so it cannot be used as a Counter dict store
-                        # directly. Instead we cast to an immutable tuple type.
-                        # ✘: count[c_k] += 1
-                        # ✓: Below.
-                        count[tuple(c_k)] += 1
-        F_k_minus_1 = [[*item] for (item, count) in count.items() if count / n > minsup]
-        F_k += F_k_minus_1
-    return F_k
+        # Count the support of every candidate, and keep the frequent ones.
+        if backend == "tidlist":
+            counts, frequent, prefix_tids = count_support_tidlist(tids, n, C_k, minsup, prefix_tids)
+        else:
+            counts, frequent = count_support(T, tx_bloom, weights, C_k, minsup)
+        cache_supports(item_ids, C_k, counts)
+        F_k_minus_1 = C_k[frequent]
+        F_k[C_k.shape[1]] = F_k_minus_1
+    return [tuple(sorted(int(item_ids[rank]) for rank in f_k)) for level in F_k.values() for f_k in level]
 
 
 def candidate_gen(F_k_minus_1):
@@ -168,97 +551,79 @@ def candidate_gen(F_k_minus_1):
     This function does implement the further step of validating these candidates. This is done in the main apriori
     algorithm.
     """
-    # Since order matters despite the notation used in the pseudocode we will have to store items as a list, as Python
-    # sets neither maintain order not accept unhashable types as elements.
-    C_k = [] # Initialize the fresh candidate list.
-
-    # Join step.
-    # The candidate generation strategy is to create a new k-sized lexical ordered list by finding all pairs of
-    # k-1-sized lexical lists which differ only in the last place and adding a new k-sized lexical item by appending
-    # the larger of the two extra elements to the other.
-    #
-    # This is relatively efficient, certainly more so than blindly appending values.
-    # A successful combination:
-    # ✓: [1, 2, 3] + [1, 2, 4] = [1, 2, 3, 4]
-    # An unsuccessful combination:
-    # ✘: {1, 2, 3} + {3, 4, 5}
-    # A gotcha is that you must select the larger of the two maxes to append! So:
-    # ☝: [1, 2, 3] + [1, 2, 4] != [1, 2, 4, 3]
-    for s_1, s_2 in itertools.combinations(F_k_minus_1, 2):
-        if s_1[:-1] == s_2[:-1] and s_1[-1] != s_2[-1]:
-            if s_1[-1] > s_2[-1]:
-                C_k.append(s_2 + [s_1[-1]])
-            else:
-                C_k.append(s_1 + [s_2[-1]])
-
-    # Pruning step.
-    # Here we eliminate candidates generated in the join step which we immediately know are not valid
-    # because they contain a k-1 size subset that is not in our known-to-be-frequent k-1 tuples, which
-    # is just the thing to rule that itemset out via downward closure.
-    # Gotcha: itertools.combinations returns a tuple, which must be cast to a list, as F_k_minus_1 is a list of lists.
-    # ☝: [c_k_minus_1 not in F_k_minus_1 for c in c_k_minus_1] is always False.
-    for c_k in C_k:
-        # print("c_k is: ", c_k)
-        # print("The k -1 tuples that c_k is being matched against F_k_minus_1 are: ", list(itertools.combinations(c_k,len(c_k) - 1)))
-        # print("F_k_minus_1 contains: ", F_k_minus_1)
-        for c_k_minus_1 in itertools.combinations(c_k, len(c_k) - 1):
-            # print(list(c_k_minus_1))
-            if any([list(c_k_minus_1) not in F_k_minus_1 for c in c_k_minus_1]):
-                # print(c_k, " removed because ", F_k_minus_1, " did not contain ", c_k_minus_1)
-                C_k.remove(c_k)
-                break
-
-    # Return.
-    return C_k
+    # Since order matters despite the notation used in the pseudocode we will have to store itemsets in order, as
+    # Python sets do not maintain it. We store them as the rows of a contiguous int32 array, sorted lexically, which is
+    # what the compiled candidate_gen_kernel() below works on. (Itemsets given as a list of lists or tuples, e.g. by
+    # hand, are converted here; each itemset must itself already be in ascending order.)
+    F = np.asarray(F_k_minus_1, dtype=np.int32)
+    if F.size == 0:
+        return np.zeros((0, F.shape[1] + 1 if F.ndim == 2 else 0), dtype=np.int32)
+    F = np.ascontiguousarray(F[np.lexsort(F.T[::-1])])
+    return candidate_gen_kernel(F)
 
 
 def genRules(minconf, minsup):
     """
-    The confidence of a
-    """
-    # A
-    pass
+    Generates and prints every association rule f - h -> h with minimum confidence minconf, over the frequent itemsets f
+    with minimum support minsup. The confidence of a rule is the fraction of the transactions containing its
+    antecedent f - h which also contain its consequent h, that is count(f) / count(f - h).
 
+    Everything needed is already in support_cache, once apriori() has run with the same or a lower minsup, or once
+    load_support_cache() has read back a cache that such a run saved. By downward closure every antecedent f - h of a
+    frequent f is itself frequent, and so was counted by apriori() along with f. No transactions are read here, so
+    rules can be generated over and over at different minimum confidences from one apriori() run.
 
-def ap_genRules(f_k, H_m , n, minconf, file):
+    Rules are printed as "antecedent -> consequent", both as sorted tuples of item labels.
+    """
+    n = support_cache[()]
+    for f_k, f_k_count in support_cache.items():
+        if len(f_k) < 2 or not f_k_count / n > minsup:
+            continue
+        # The one-item consequents are checked here, and ap_genRules() grows the confident ones from there.
+        H_1 = []
+        for item in f_k:
+            antecedent = tuple(i for i in f_k if i != item)
+            if f_k_count / support_cache[antecedent] > minconf:
+                print(antecedent, "->", (item,))
+                H_1.append((item,))
+        ap_genRules(f_k, H_1, minconf)
+
+
+def ap_genRules(f_k, H_m, minconf):
     """
-    :param f_k: A frequent itemset of size k.
-    :param H_m: The set of m-item consequents.
+    :param f_k: A frequent itemset of size k, as a sorted tuple of item labels, whose support apriori() has counted
+        into support_cache.
+    :param H_m: The list of confident m-item consequents of f_k, as sorted tuples of item labels.
+    :param minconf: The minimum confidence of an outputted rule.
     :return:
     """
     # We start with what we assume is a single non-empty frequent itemset of length k, f_k, and a non-empty set
     #  of consequents all of length m < k, H_m. We iterate through the list of items and build confidences for each
     # f_k - h_m+1 to h_m+1 rule, and either keep and output it if we are right or delete it from the list entirely if
     #  we are not.
-    if H_m and f_k and len(f_k) > len(H_m[0]):
+    # The antecedent f_k - h_m+1 must not be empty, so growing the consequents to m+1 items only makes sense while
+    # that leaves at least one item of f_k over: k > m + 1.
+    if H_m and f_k and len(f_k) > len(H_m[0]) + 1:
         # Initialize the set of frequent itemsets of a size one larger using the earlier candidate_gen algorithm.
-        H_m_plus_1 = candidate_gen(H_m)
-        # Initialize the counter. The values stored here will be used for
-        counts = collections.Counter()
-        # Unlike in the pseudo-code this process is IO-bound. So we open a file and throw things at the counter,
-        # and then compute confidence and support as the end step.
-        with open(file) as f:
-            for line in tqdm(f):
-                # Pre-compute the itemset for the line so all checks can be run without recalculating it.
-                check_set = {int(n) for n in line.replace("\n", "").split(",")[1:]}
-                # If f_k itself appears in the set being checked, add that fact to the tally.
-                if set(f_k).issubset(check_set):
-                    print("Checkpoint")
-                    counts[tuple(f_k)] += 1
-                # Then for ech of the consequents check if f_k less that consequent appears. If it does,
-                # add to that consequent's tally.
-                for h_k_plus_1 in H_m_plus_1:
-                    print(set(f_k).symmetric_difference(set(h_k_plus_1)))
-                    if (set(f_k).symmetric_difference(set(h_k_plus_1))).issubset(check_set):
-                        counts[tuple(h_k_plus_1)] += 1
+        # Item labels may be arbitrarily large integers, so the consequents are handed to it as positions in f_k,
+        # which are small and in the same order, and mapped back afterwards.
+        position = {item: p for (p, item) in enumerate(f_k)}
+        H_m_plus_1 = [tuple(f_k[p] for p in h) for h in candidate_gen([[position[i] for i in h] for h in H_m]).tolist()]
+        # The count of f_k itself does not change from one level of the recursion to the next. What remains is, for
+        # each of the consequents, the count of f_k less that consequent. Every such antecedent is a subset of the
+        # frequent f_k, and therefore frequent itself, so apriori() has already counted it, and we look it up in
+        # support_cache. Like every itemset here the antecedents are sorted tuples; f_k is already sorted, so filtering
+        # the consequent out of it keeps them sorted without building a set or sorting anything.
+        f_k_count = support_cache[f_k]
+        antecedents = [tuple(item for item in f_k if item not in h_m_plus_1) for h_m_plus_1 in H_m_plus_1]
         # Go back through the consequent set now. Compute the confidence for each possible rule, and if the
         # confidence is high enough---we already know from candidate_gen output that it will be frequent
-        # enough---output the rule! Otherwise remove the rule from the list, as we certainly will not get a bigger
-        # one per the logic at the beginning.
-        print(counts)
-        for h_m_plus_1 in H_m_plus_1:
-            if counts[tuple(f_k)] / counts[set(h_k_plus_1)] > minconf:
-                print(tuple(h_k_plus_1))
-            else:
-                H_m_plus_1.remove(h_m_plus_1)
-        ap_genRules(f_k, H_m_plus_1, n, minconf, file)
+        # enough---output the rule! Otherwise leave the rule out of the list, as we certainly will not get a bigger
+        # one per the logic at the beginning. The surviving consequents go into a new list, rather than removing the
+        # others from H_m_plus_1 while walking it.
+        H_m_plus_1_confident = []
+        for h_m_plus_1, antecedent in zip(H_m_plus_1, antecedents):
+            if f_k_count / support_cache[antecedent] > minconf:
+                print(antecedent, "->", h_m_plus_1)
+                H_m_plus_1_confident.append(h_m_plus_1)
+        ap_genRules(f_k, H_m_plus_1_confident, minconf)
@@ -0,0 +1,228 @@
+"""
+Numba kernels behind the apriori module. These are the compiled inner loops of parsing the transaction file,
+counting support, and generating candidates; the functions in apriori.py prepare their inputs and call them.
+
+Every kernel is compiled with cache=True, so the compiled machine code is written next to this file and reused by
+later sessions instead of being recompiled on first call.
+
+None of them are compiled with fastmath. The counting kernels decide frequency with out[j] / n > minsup, and fastmath
+lets LLVM rewrite that division as a multiplication by 1 / n, whose rounding flips the comparison for a candidate with
+support of exactly minsup. Everything else in them is integer work that fastmath doesn't speed up anyway.
+"""
+
+from numba import njit, prange, types
+from numba.extending import intrinsic
+import numpy as np
+
+
+@njit(parallel=True, boundscheck=False, cache=True)
+def parse_tokens(buf, starts, out, valid):
+    """
+    Numba kernel behind parse_transactions(). Writes into out[i] the non-negative integer whose digits start at
+    buf[starts[i]] and run up to the next comma or newline. Whitespace around the digits, such as the space in ", 2" or
+    a carriage return, is skipped. valid[i] is set to whether the token was such an integer at all: a token with no
+    digits, or with any byte other than a digit or whitespace (a sign, a decimal point, a letter), is not.
+    """
+    for i in prange(len(starts)):
+        value = 0
+        digits = 0
+        ok = True
+        p = starts[i]
+        while p < len(buf) and buf[p] != 44 and buf[p] != 10:  # ord(","), ord("\n")
+            digit = np.int64(buf[p]) - 48  # ord("0")
+            if 0 <= digit <= 9:
+                value = value * 10 + digit
+                digits += 1
+            elif buf[p] != 32 and buf[p] != 9 and buf[p] != 13:  # ord(" "), ord("\t"), ord("\r")
+                ok = False
+            p += 1
+        out[i] = value
+        valid[i] = ok and digits > 0
+
+
+@intrinsic
+def popcount(typingctx, x):
+    """
+    The number of set bits in the uint64 x, for use in Numba kernels. Compiles down to LLVM's ctpop intrinsic, and so
+    to a single POPCNT instruction, rather than to a bit-twiddling loop.
+    """
+    if x != types.uint64:
+        return None
+
+    def codegen(context, builder, signature, args):
+        return builder.ctpop(args[0])
+
+    return types.uint64(types.uint64), codegen
+
+
+@njit(parallel=True, boundscheck=False, cache=True)
+def count_support_kernel(T, weights, tx_bloom, C, cand_bloom, run_item, run_start, n, minsup, n_threads, out,
+                         out_mask):
+    """
+    Numba kernel behind count_support(). Writes into out[j] the number of transactions containing every bit of the
+    packed candidate C[j], and into out_mask[j] whether that makes C[j] frequent with minimum support minsup. Each row
+    of the packed transaction matrix T stands for weights[i] identical transactions (see deduplicate()), out of n.
+    tx_bloom and cand_bloom are the Bloom filters of the transactions and of the candidates (see item_bloom()), which
+    are compared before the full bitsets are.
+
+    The candidates come grouped into runs sharing the same rarest item: C[run_start[r]:run_start[r + 1]] are the
+    candidates whose rarest item is run_item[r]. This is an inverted index from that item to its candidates, one level
+    deep. Every transaction looks up each run's item once, and passes over the whole run if it doesn't have it, which
+    for the rarest item of a candidate is most of the time. Only the candidates of the runs it does have are compared.
+
+    A transaction contains a candidate if and only if popcount(t & c) == popcount(c), summed over the words. The right
+    hand side is computed once per candidate up front, so the test itself is a branchless run of ANDs and popcounts.
+
+    The transactions are split into one contiguous block for each of n_threads threads. Every thread counts its block
+    into a private row of partial counts, so that no two threads ever increment the same counter, and the rows are
+    summed at the end. (n_threads is passed in, rather than read with numba.get_num_threads() in here, because that
+    would keep the kernel from being cached.)
+    """
+    n_tx, n_words = T.shape
+    n_candidates = C.shape[0]
+    cand_popcount = np.zeros(n_candidates, dtype=np.uint64)
+    for j in range(n_candidates):
+        for w in range(n_words):
+            cand_popcount[j] += popcount(C[j, w])
+    n_blocks = min(n_threads, n_tx)
+    partial = np.zeros((n_blocks, n_candidates), dtype=np.int32)
+    for b in prange(n_blocks):
+        for i in range(b * n_tx // n_blocks, (b + 1) * n_tx // n_blocks):
+            for r in range(run_item.shape[0]):
+                item = run_item[r]
+                if (T[i, item >> 6] >> np.uint64(item & 63)) & np.uint64(1) == 0:
+                    continue
+                for j in range(run_start[r], run_start[r + 1]):
+                    if (tx_bloom[i] & cand_bloom[j]) != cand_bloom[j]:
+                        continue
+                    shared = np.uint64(0)
+                    for w in range(n_words):
+                        shared += popcount(T[i, w] & C[j, w])
+                    if shared == cand_popcount[j]:
+                        partial[b, j] += weights[i]
+    for j in range(n_candidates):
+        out[j] = 0
+        for b in range(n_blocks):
+            out[j] += partial[b, j]
+        out_mask[j] = out[j] / n > minsup
+
+
+@njit(parallel=True, boundscheck=False, cache=True)
+def count_support_kernel_w1(T, weights, C, run_item, run_start, n, minsup, n_threads, out, out_mask):
+    """
+    count_support_kernel() specialized to at most 64 frequent items, when every transaction and every candidate fits
+    in a single word. T and C are then the 1D arrays of those words, and a transaction t contains a candidate c if and
+    only if t & c == c.
+
+    That one AND and compare is no more work than the Bloom filter check it would stand in front of, so this kernel
+    doesn't take the Bloom filters, and it has no loop over words or popcounts. What is left of the inner loop is one
+    AND, compare and add per candidate, over a contiguous run of candidates.
+
+    T and C must be contiguous (count_support() passes T.ravel() and C.ravel(), not T[:, 0]); a strided column view is
+    compiled to slower generic indexing.
+    """
+    n_tx = T.shape[0]
+    n_candidates = C.shape[0]
+    n_blocks = min(n_threads, n_tx)
+    partial = np.zeros((n_blocks, n_candidates), dtype=np.int32)
+    for b in prange(n_blocks):
+        for i in range(b * n_tx // n_blocks, (b + 1) * n_tx // n_blocks):
+            t = T[i]
+            w = weights[i]
+            for r in range(run_item.shape[0]):
+                if (t >> np.uint64(run_item[r])) & np.uint64(1) == 0:
+                    continue
+                for j in range(run_start[r], run_start[r + 1]):
+                    if (t & C[j]) == C[j]:
+                        partial[b, j] += w
+    for j in range(n_candidates):
+        out[j] = 0
+        for b in range(n_blocks):
+            out[j] += partial[b, j]
+        out_mask[j] = out[j] / n > minsup
+
+
+@njit(boundscheck=False, cache=True)
+def contains_row(F, c, skip):
+    """
+    Whether the lexically sorted int32 matrix F has a row equal to the row c with its element at position skip
+    removed. A binary search, so O(log(len(F))) row comparisons.
+    """
+    lo, hi = 0, F.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        order = 0
+        for w in range(F.shape[1]):
+            c_w = c[w] if w < skip else c[w + 1]
+            if F[mid, w] != c_w:
+                order = -1 if F[mid, w] < c_w else 1
+                break
+        if order == 0:
+            return True
+        if order < 0:
+            lo = mid + 1
+        else:
+            hi = mid
+    return False
+
+
+@njit(parallel=True, boundscheck=False, cache=True)
+def candidate_gen_kernel(F):
+    """
+    Numba kernel behind candidate_gen(). F holds the k-1-level itemsets as the rows of a lexically sorted int32
+    matrix, and the k-level candidates are returned the same way.
+    """
+    n, k_minus_1 = F.shape
+
+    # Join step.
+    # The candidate generation strategy is to create a new k-sized lexical ordered list by finding all pairs of
+    # k-1-sized lexical lists which differ only in the last place and adding a new k-sized lexical item by appending
+    # the larger of the two extra elements to the other.
+    #
+    # This is relatively efficient, certainly more so than blindly appending values.
+    # A successful combination:
+    # ✓: [1, 2, 3] + [1, 2, 4] = [1, 2, 3, 4]
+    # An unsuccessful combination:
+    # ✘: {1, 2, 3} + {3, 4, 5}
+    # A gotcha is that you must select the larger of the two maxes to append! So:
+    # ☝: [1, 2, 3] + [1, 2, 4] != [1, 2, 4, 3]
+    #
+    # Trying every pair of itemsets would be quadratic in the size of F, and almost every pair would fail to share a
+    # prefix. But since F is sorted lexically, the itemsets sharing a k-2-sized prefix form a contiguous run of rows,
+    # with their last elements in ascending order, which takes care of the gotcha above for us. So we find the runs,
+    # and combine pairs within a run. The first pass only counts the pairs, so that the output can be allocated once.
+    run_starts = np.zeros(n + 1, dtype=np.int64)
+    n_runs = 0
+    for i in range(n):
+        if i == 0 or (F[i, :k_minus_1 - 1] != F[i - 1, :k_minus_1 - 1]).any():
+            run_starts[n_runs] = i
+            n_runs += 1
+    run_starts[n_runs] = n
+    offsets = np.zeros(n_runs + 1, dtype=np.int64)
+    for r in range(n_runs):
+        length = run_starts[r + 1] - run_starts[r]
+        offsets[r + 1] = offsets[r] + length * (length - 1) // 2
+    C = np.empty((offsets[n_runs], k_minus_1 + 1), dtype=np.int32)
+    for r in prange(n_runs):
+        out = offsets[r]
+        for a in range(run_starts[r], run_starts[r + 1]):
+            for b in range(a + 1, run_starts[r + 1]):
+                C[out, :k_minus_1] = F[a]
+                C[out, k_minus_1] = F[b, k_minus_1 - 1]
+                out += 1
+
+    # Pruning step.
+    # Here we eliminate candidates generated in the join step which we immediately know are not valid
+    # because they contain a k-1 size subset that is not in our known-to-be-frequent k-1 tuples, which
+    # is just the thing to rule that itemset out via downward closure.
+    # Dropping either of the last two elements of a candidate gives back the two rows it was joined from, so only the
+    # subsets dropping one of the first k-2 elements need checking. Each check is a binary search of the sorted F.
+    keep = np.ones(C.shape[0], dtype=np.bool_)
+    for j in prange(C.shape[0]):
+        for skip in range(k_minus_1 - 1):
+            if not contains_row(F, C[j], skip):
+                keep[j] = False
+                break
+
+    # Return.
+    return C[keep]
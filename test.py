@@ -1,3 +1,25 @@
 import apriori
+import numpy as np
+import os
+import tempfile
 
-apriori.apriori("75000-out1.csv", 0.01)
\ No newline at end of file
+apriori.apriori("75000-out1.csv", 0.01)
+apriori.genRules(0.3, 0.01)
+
+# Support exactly at minsup is not frequent. Items 1 and 2 are frequent on their own, and appear together in exactly 3
+# of 105 transactions, so with minsup = 3 / 105 the pair must be left out by every backend and bitset width.
+with tempfile.TemporaryDirectory() as tmp:
+    file = os.path.join(tmp, "boundary.csv")
+    with open(file, "w") as f:
+        for t in range(105):
+            items = [1, 2] if t < 3 else [1] if t < 10 else [2] if t < 17 else [3]
+            f.write(",".join(str(i) for i in [t + 1] + items) + "\n")
+    for backend in ("bitset", "tidlist"):
+        assert (1, 2) not in apriori.apriori(file, 3 / 105, backend=backend)
+    M, item_ids = apriori.load_bitmatrix(file)
+    M, weights = apriori.deduplicate(M)
+    T = apriori.pack_bitmatrix(M)
+    T = np.hstack([T, np.zeros_like(T)])  # Two words, so that count_support_kernel() is used.
+    pair = [list(np.searchsorted(item_ids, [1, 2]))]
+    counts, frequent = apriori.count_support(T, apriori.bloom_summary(M), weights, pair, 3 / 105)
+    assert counts[0] == 3 and not frequent[0]